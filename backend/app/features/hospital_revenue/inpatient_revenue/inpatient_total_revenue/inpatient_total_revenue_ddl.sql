@@ -0,0 +1,107 @@
+-- 住院收入（inpatient_total_revenue）依赖的数据库对象
+-- 执行：psql -d <db> -f inpatient_total_revenue_ddl.sql（可重复执行）
+
+----------------------------------------------------------------
+-- 科室 → 医生映射：物化视图
+-- /init 每次加载都要对 t_workload_doc_2dep_def 全表做
+-- GROUP BY + DISTINCT + jsonb 构造，这张表很少变动，直接物化
+----------------------------------------------------------------
+-- 定义变更后重跑本脚本即可重建（视图是派生数据）
+DROP MATERIALIZED VIEW IF EXISTS mv_dep_doc_map;
+CREATE MATERIALIZED VIEW mv_dep_doc_map AS
+SELECT
+  s.dep_id,
+  s.dep_name,
+  -- 先在明细列上去重，组内按工号排好，接口不用再排序
+  JSON_AGG(
+    jsonb_build_object('doc_id', s.doc_id, 'doc_name', s.doc_name)
+    ORDER BY s.doc_id COLLATE "C", s.doc_name
+  ) AS doctors
+FROM (
+  SELECT DISTINCT
+    d."绩效科室ID"   AS dep_id,
+    d."绩效科室名称" AS dep_name,
+    d."工号"         AS doc_id,
+    d."姓名"         AS doc_name
+  FROM t_workload_doc_2dep_def d
+  WHERE
+    d."工号" <> ''
+    AND d."姓名" <> ''
+    AND d."绩效科室ID" <> ''
+    AND d."绩效科室名称" <> ''
+) s
+GROUP BY
+  s.dep_id,
+  s.dep_name;
+
+-- REFRESH ... CONCURRENTLY 需要唯一索引；
+-- 同一科室ID可能挂了多个名称，按 (dep_id, dep_name) 建
+CREATE UNIQUE INDEX ux_mv_dep_doc_map
+  ON mv_dep_doc_map (dep_id, dep_name);
+
+-- 映射表变更后自动刷新（语句级触发，批量导入只刷新一次）
+-- 刷新在写入方的语句里同步执行，而 REFRESH 要求是视图属主：
+-- 函数用 SECURITY DEFINER 以属主身份执行（本脚本须由 mv_dep_doc_map 的属主执行，
+-- 函数属主即视图属主），固定 search_path 防止被调用方的同名对象劫持；
+-- 这样只有映射表写权限、不拥有视图的维护 / ETL 角色写入也不会失败
+CREATE OR REPLACE FUNCTION fn_refresh_mv_dep_doc_map()
+RETURNS trigger
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public, pg_temp
+AS $$
+BEGIN
+  REFRESH MATERIALIZED VIEW CONCURRENTLY mv_dep_doc_map;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_refresh_mv_dep_doc_map ON t_workload_doc_2dep_def;
+CREATE TRIGGER trg_refresh_mv_dep_doc_map
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON t_workload_doc_2dep_def
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_refresh_mv_dep_doc_map();
+
+----------------------------------------------------------------
+-- 历史日汇总：t_dep_income_inp / t_doc_fee_inp / t_dep_count_inbed 是物化视图
+-- （见 总收入.md），不是按日期追加写入的表。REFRESH MATERIALIZED VIEW 按视图查询
+-- 的输出顺序整表重写，日期与物理块没有相关性保证，BRIN 的块范围摘要不可靠，
+-- 日期范围查询用普通 btree
+-- t_workload_inp_f / t_workload_inbed_reg_f 是 postgres_fdw 外部表，
+-- 不能在本库建索引，需在源库处理
+-- CONCURRENTLY 不能在事务块里执行：用 psql -f 逐条提交执行
+----------------------------------------------------------------
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dep_income_inp_rcpt_date
+  ON t_dep_income_inp (rcpt_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_doc_fee_inp_billing_date
+  ON t_doc_fee_inp (billing_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dep_count_inbed_inbed_date
+  ON t_dep_count_inbed (inbed_date);
+
+-- 早先版本建的 BRIN 索引，被上面的 btree 取代
+DROP INDEX CONCURRENTLY IF EXISTS brin_dep_income_inp_rcpt_date;
+DROP INDEX CONCURRENTLY IF EXISTS brin_doc_fee_inp_billing_date;
+DROP INDEX CONCURRENTLY IF EXISTS brin_dep_count_inbed_inbed_date;
+
+----------------------------------------------------------------
+-- 按科室过滤的历史查询：等值列在前、日期在后，直接按 (科室, 日期) 范围定位
+-- 外部表的日期列本身就是 date，仓库里不再对其做 ::date 转换，
+-- 远端按原列做范围裁剪
+-- 不做 INCLUDE 覆盖索引：这些物化视图每次 REFRESH 都是新堆，VACUUM 之前
+-- 可见性映射全未置位，index-only scan 照样逐行回表，覆盖列只会让索引变大。
+-- 普通 (过滤列, 日期) 索引已把扫描限定在命中的行上，回表只取这些行
+----------------------------------------------------------------
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dep_income_inp_dep_name_rcpt_date
+  ON t_dep_income_inp (dep_name, rcpt_date);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_doc_fee_inp_doc_code_billing_date
+  ON t_doc_fee_inp (doc_code, billing_date);
+
+-- 早先版本建的覆盖索引，被上面的普通索引取代（键列相同）
+DROP INDEX CONCURRENTLY IF EXISTS ix_dep_income_inp_dep_name_rcpt_date_cover;
+DROP INDEX CONCURRENTLY IF EXISTS ix_doc_fee_inp_doc_code_billing_date_cover;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dep_count_inbed_dep_code_inbed_date
+  ON t_dep_count_inbed (dep_code, inbed_date);
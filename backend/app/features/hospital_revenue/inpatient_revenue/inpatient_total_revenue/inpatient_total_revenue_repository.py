@@ -1,75 +1,114 @@
 # backend/app/repositories/inpatient_total_revenue_repository.py
 
+import copy
+import hashlib
 import logging
-from datetime import date, datetime, timedelta
-from decimal import Decimal
-from typing import Any, Dict, List, Optional
+import re
+import threading
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
 
-from .....shared.db import get_conn, put_conn
+from psycopg2 import errors
+
+from .....shared.cache import cache_clear, cache_get, cache_set
+from .....shared.db import get_db_connection, get_pool_max_connections, use_float_numeric
 
 logger = logging.getLogger("inpatient_total_revenue.repository")
 
+# 看板轮询频繁，映射允许几十秒的延迟
+DEP_DOC_MAP_CACHE_KEY = "inpatient_total_revenue:dep_doc_map"
+DEP_DOC_MAP_TTL_SECONDS = 60
+HIS_DEP_MAP_CACHE_KEY = "inpatient_total_revenue:his_dep_map"
+HIS_DEP_MAP_TTL_SECONDS = 60
+
+# /init 响应体按日期分 key 缓存（路由层使用），映射失效时一并清掉
+INIT_CACHE_KEY_PREFIX = "inpatient_total_revenue:init:v3"
+
+
+def init_cache_key(day: date) -> str:
+    return f"{INIT_CACHE_KEY_PREFIX}:{day.isoformat()}"
+
+# 科室模式下整个区间都在今天之前时，收入只取决于历史日汇总，按参数缓存。
+# 床日的实时登记表仍按整个区间查，过去日期偶有补录：这部分滞后按 TTL 接受。
+# 医生模式的收入实时分支同样按整个区间查事实表，不缓存。
+# 缓存项与返回值互不共享（存、取各深拷贝一份），调用方修改结果不会污染缓存
+HIST_RESULT_CACHE_PREFIX = "inpatient_total_revenue:full"
+HIST_RESULT_TTL_SECONDS = 600
+# shared.cache 是全进程共用、按先进先出淘汰的有限容量缓存：
+# 明细超过该行数的结果（长区间不分页）不缓存，分页只缓存第一页，
+# 避免大结果 / 大量翻页占满容量、挤掉其他功能的缓存项
+HIST_RESULT_MAX_DETAIL_ROWS = 500
+
+# 收入明细区间超过该天数时改用服务端游标分批拉取，避免 libpq 一次缓存整个结果集
+# （取回的行仍全部放进一个列表，Python 侧内存不变）
+STREAM_MIN_DAYS = 31
+STREAM_ITERSIZE = 2000  # 服务端游标每次 fetchmany 的行数（不使用 cursor.itersize）
+
+# 一次请求里互不依赖的语句可以各借一个连接并发执行（调用线程自己跑一批，其余交给这里）。
+# 连接池满时 getconn() 直接抛 PoolError 而不是等待，所以后台语句要限量：
+# 全进程同时在后台执行的语句数不超过 QUERY_WORKERS，也不超过连接池上限的 1/4
+# （其余连接留给请求线程）；拿不到名额的语句在调用线程上与第一条共用一个连接顺序执行
+QUERY_WORKERS = 4
+_query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="itr_query")
+_fanout_slots: Optional[threading.BoundedSemaphore] = None
+_fanout_lock = threading.Lock()
+
+
+def _fanout_semaphore() -> threading.BoundedSemaphore:
+    """后台语句名额；连接池在模块导入之后才初始化，首次使用时再按池上限确定"""
+    global _fanout_slots
+    if _fanout_slots is None:
+        with _fanout_lock:
+            if _fanout_slots is None:
+                n = min(QUERY_WORKERS, get_pool_max_connections() // 4)
+                _fanout_slots = threading.BoundedSemaphore(max(n, 0))
+    return _fanout_slots
+
 
 # ========== 小工具函数 ==========
 
-def _norm_deps(dep_or_deps) -> Optional[List[str]]:
-    """
-    统一把科室参数变成 List[str] 或 None（用于科室名称）
-    """
-    if dep_or_deps is None:
-        return None
-    if isinstance(dep_or_deps, (list, tuple, set)):
-        arr = [str(x).strip() for x in dep_or_deps if x is not None and str(x).strip()]
-        return arr or None
-    s = str(dep_or_deps).strip()
-    if not s:
-        return None
-    if "," in s:
-        arr = [x.strip() for x in s.split(",") if x.strip()]
-        return arr or None
-    return [s]
+def _is_clean_str_list(v) -> bool:
+    """已经是非空、元素都是去过空白的非空字符串的 list（前端最常见的传法）"""
+    return (
+        type(v) is list
+        and bool(v)
+        and all(
+            type(x) is str and x and not x[0].isspace() and not x[-1].isspace()
+            for x in v
+        )
+    )
 
 
-def _norm_docs(doc_or_docs) -> Optional[List[str]]:
+def _strip_items(items) -> Optional[List[str]]:
+    """单遍：每个元素只 str()/strip() 一次，丢掉 None 和空串"""
+    arr = [v for v in (str(x).strip() for x in items if x is not None) if v]
+    return arr or None
+
+
+def _norm_list(v) -> Optional[List[str]]:
     """
-    统一把医生参数变成 List[str] 或 None（用于医生工号）
+    统一把 列表 / 逗号分隔字符串 / 单值 参数变成 List[str] 或 None
     """
-    if doc_or_docs is None:
+    if v is None:
         return None
-    if isinstance(doc_or_docs, (list, tuple, set)):
-        arr = [str(x).strip() for x in doc_or_docs if x is not None and str(x).strip()]
-        return arr or None
-    s = str(doc_or_docs).strip()
+    if _is_clean_str_list(v):
+        return v
+    if isinstance(v, (list, tuple, set)):
+        return _strip_items(v)
+    s = str(v).strip()
     if not s:
         return None
     if "," in s:
-        arr = [x.strip() for x in s.split(",") if x.strip()]
-        return arr or None
+        return _strip_items(s.split(","))
     return [s]
 
 
-def _prim_for_json(v: Any):
-    """
-    将 DB 值转成 JSON 友好的基础类型
-    （注意：日期会转成 ISO 字符串，在 get_full_revenue 再转回 date 对象）
-    """
-    if isinstance(v, Decimal):
-        return float(v)
-    if isinstance(v, (date, datetime)):
-        return v.isoformat()
-    return v
-
-
-def _parse_date_str(s: Any) -> Optional[date]:
-    if not s:
-        return None
-    if isinstance(s, date):
-        return s
-    try:
-        # 只取日期部分
-        return date.fromisoformat(str(s)[:10])
-    except Exception:
-        return None
+# 科室名称 / 医生工号 的规范化规则相同
+_norm_deps = _norm_docs = _norm_list
 
 
 def _shift_year(d: date, years: int) -> date:
@@ -102,6 +141,603 @@ def _pct_change(cur: float, base: Optional[float]) -> Optional[float]:
     return (cur - base) / base * 100.0
 
 
+# ========== 预备语句 ==========
+
+_PARAM_RE = re.compile(r"%\((\w+)\)s")
+
+
+@dataclass(frozen=True)
+class _Statement:
+    """
+    服务端预备语句（PREPARE / EXECUTE）：
+
+    - name：PREPARE 使用的语句名，每个连接会话只 PREPARE 一次；
+      构造时自动追加 SQL 文本的短哈希，SQL 改动后名字随之变化，
+      不会 EXECUTE 到同名的旧语句
+    - sql：命名参数形式（%(xxx)s）的原始 SQL
+    - arg_types：(参数名, PG 类型) 列表，顺序即 $1..$n 的顺序
+
+    仪表盘刷新时同一批 SQL 会被反复执行，走 EXECUTE 可以省掉每次的解析与规划。
+    """
+    name: str
+    sql: str
+    arg_types: Tuple[Tuple[str, str], ...] = ()
+
+    def __post_init__(self):
+        digest = hashlib.sha1(self.sql.encode("utf-8")).hexdigest()[:8]
+        object.__setattr__(self, "name", f"{self.name}_{digest}")
+
+    @property
+    def prepare_sql(self) -> str:
+        index = {k: i + 1 for i, (k, _) in enumerate(self.arg_types)}
+        body = _PARAM_RE.sub(lambda m: f"${index[m.group(1)]}", self.sql)
+        if not self.arg_types:
+            return f"PREPARE {self.name} AS {body}"
+        types = ", ".join(t for _, t in self.arg_types)
+        return f"PREPARE {self.name} ({types}) AS {body}"
+
+    @property
+    def execute_sql(self) -> str:
+        if not self.arg_types:
+            return f"EXECUTE {self.name}"
+        args = ", ".join(f"%({k})s" for k, _ in self.arg_types)
+        return f"EXECUTE {self.name} ({args})"
+
+
+# 科室 → 医生映射：聚合已物化到 mv_dep_doc_map（见 inpatient_total_revenue_ddl.sql），
+# 映射表变更时由触发器刷新
+_SQL_DEP_DOC_MAP = """
+SELECT
+  dep_id,
+  dep_name,
+  doctors
+FROM mv_dep_doc_map
+ORDER BY
+  dep_id
+"""
+
+# HIS 科室编码 -> 绩效科室名称（小维表，整表取回缓存，用来把科室名称解析成 HIS 编码）
+_SQL_HIS_DEP_MAP = """
+SELECT
+  d."HIS科室编码"  AS his_code,
+  d."绩效科室名称" AS dep_name
+FROM t_workload_dep_def2his d
+WHERE
+  d."HIS科室编码" IS NOT NULL
+  AND d."绩效科室名称" IS NOT NULL
+"""
+
+# ---- 区间参数 ----
+# 历史/实时的分界（今天）在 Python 里算好作为普通参数传入，SQL 里不出现 CURRENT_DATE：
+#   {p}start_date / {p}end_date：查询区间 [start, end)
+#   {p}hist_end  ：历史表上界 = min(end, today)
+#   {p}live_start / {p}live_end：实时表区间 = [max(start, today), min(end, today + 1))
+# p 为参数名前缀，一条语句里带多个区间（当期 / 去年同期）时区分用
+
+def _window_args(p: str = "") -> Tuple[Tuple[str, str], ...]:
+    return tuple(
+        (f"{p}{k}", "date")
+        for k in ("start_date", "end_date", "hist_end", "live_start", "live_end")
+    )
+
+
+def _window_params(start: date, end: date, today: date, p: str = "") -> Dict[str, Any]:
+    return {
+        f"{p}start_date": start,
+        f"{p}end_date": end,
+        f"{p}hist_end": min(end, today),
+        f"{p}live_start": max(start, today),
+        f"{p}live_end": min(end, today + timedelta(days=1)),
+    }
+
+
+def _window_phase(start: date, end: date, today: date) -> str:
+    """
+    区间相对今天的位置，决定 SQL 需要哪几条分支：
+    - hist ：全部在今天之前，只查历史表
+    - live ：从今天开始，历史表没有数据
+    - mixed：跨今天，历史 + 实时
+    """
+    if end <= today:
+        return "hist"
+    if start >= today:
+        return "live"
+    return "mixed"
+
+
+_PHASES = ("hist", "live", "mixed")
+
+
+def _without_live_income(phase: str) -> Optional[str]:
+    """
+    所选科室一个 HIS 编码都没映射到时，实时收入分支必然为空：
+    mixed 退化为只查历史（hist）；live 整个收入区间为空，返回 None。
+    （床日 CTE 的 hist / mixed 完全相同，退化不影响床日）
+    """
+    if phase == "mixed":
+        return "hist"
+    if phase == "live":
+        return None
+    return phase
+
+
+def _dep_filter(col: str, deps: bool, indent: str = "      ", keyword: str = "AND") -> str:
+    """
+    科室过滤条件：有科室时才拼 col = ANY(...)。
+    不写成 (x IS NULL OR ...)，规划器才能按索引/下推处理这个条件。
+    """
+    if not deps:
+        return ""
+    return f"\n{indent}{keyword} {col} = ANY(%(departments)s)"
+
+
+# 以下 CTE 在每条语句里都只引用一次，统一写 AS NOT MATERIALIZED：
+# 明确让规划器内联，外层的日期/科室条件可以下推到基表扫描
+
+def _union_legs(phase: str, hist: str, live: str) -> str:
+    if phase == "hist":
+        return hist
+    if phase == "live":
+        return live
+    return f"{hist}\n\n    UNION ALL\n{live}"
+
+
+def _his_filter(col: str, deps: bool) -> str:
+    """实时事实表上的 HIS 科室编码过滤（编码由绩效科室名称在 Python 里解析好）"""
+    if not deps:
+        return ""
+    return f"\n        AND {col} = ANY(%(his_codes)s)"
+
+
+def _dep_income_cte(
+    p: str = "",
+    phase: str = "mixed",
+    deps: bool = True,
+    name: str = "dep_incom",
+    narrow: bool = False,
+) -> str:
+    """
+    科室收入 CTE（默认名 dep_incom），按 phase 只拼需要的分支。
+    narrow：只出 rcpt_date / charges 两列（按日透视只用到这两列），
+    实时分支也只按 日期+HIS 科室 聚合，不再按项目分类分组。
+    未选科室时明细不区分项目类，实时分支同样不按项目分类分组（项目类出 NULL）。
+    """
+    amount = "" if narrow else """,
+      x.amount::numeric        AS amount"""
+    hist_cols = "" if narrow else """
+      x.dep_code::text         AS dep_code,
+      x.dep_name::text         AS dep_name,
+      x.item_class_name::text  AS item_class_name,"""
+    hist = f"""
+    ----------------------------------------------------------------
+    -- 历史部门收入：t_dep_income_inp
+    ----------------------------------------------------------------
+    SELECT
+      x.rcpt_date::date        AS rcpt_date,{hist_cols}
+      x.charges::numeric       AS charges{amount}
+    FROM t_dep_income_inp x
+    WHERE
+      x.rcpt_date >= %({p}start_date)s
+      AND x.rcpt_date <  %({p}hist_end)s{_dep_filter("x.dep_name", deps)}"""
+    if narrow:
+        live_cols = """
+      f.rcpt_date,
+      f.charges"""
+    else:
+        item_class = "f.item_class_name" if deps else "NULL::text               AS item_class_name"
+        live_cols = f"""
+      f.rcpt_date,
+      f.dep_code,
+      d."绩效科室名称"::text    AS dep_name,
+      {item_class},
+      f.charges,
+      f.amount"""
+    by_item = deps and not narrow
+    inner_amount = "" if narrow else """,
+        SUM(f.amount)::numeric   AS amount"""
+    inner_cols = "" if not by_item else """
+        f.item_class_name::text  AS item_class_name,"""
+    inner_group = "" if not by_item else """,
+        f.item_class_name"""
+    live = f"""
+    ----------------------------------------------------------------
+    -- 当日实时部门收入：t_workload_inp_f + t_workload_dep_def2his
+    ----------------------------------------------------------------
+    -- 先在事实表上按 HIS 科室编码聚合（可整体下推到远端），再关联一次科室映射；
+    -- 按科室过滤时先用 HIS 编码缩小事实表，再按绩效科室名称精确过滤
+    -- （一个 HIS 编码可能映射到多个绩效科室）
+    SELECT{live_cols}
+    FROM (
+      SELECT
+        f.rcpt_date,
+        f.patient_in_dept::text  AS dep_code,{inner_cols}
+        SUM(f.charges)::numeric  AS charges{inner_amount}
+      FROM t_workload_inp_f f
+      WHERE
+        f.rcpt_date >= %({p}live_start)s
+        AND f.rcpt_date <  %({p}live_end)s{_his_filter("f.patient_in_dept", deps)}
+      GROUP BY
+        f.rcpt_date,
+        f.patient_in_dept{inner_group}
+    ) f
+    LEFT JOIN t_workload_dep_def2his d
+      ON d."HIS科室编码" = f.dep_code{_dep_filter('d."绩效科室名称"', deps, "    ", "WHERE")}"""
+    return f"""
+{name} AS NOT MATERIALIZED ({_union_legs(phase, hist, live)}
+)"""
+
+
+def _doc_income_cte(p: str = "", name: str = "doc_income", narrow: bool = False) -> str:
+    """
+    医生收入 CTE（默认名 doc_income）；只在医生模式使用，工号列表必有。
+    narrow：只出 rcpt_date / costs，两条分支都只按日期聚合，不需要姓名。
+    """
+    def live_where(indent: str) -> str:
+        return f"""
+{indent}WHERE
+{indent}  f.rcpt_date >= %({p}start_date)s
+{indent}  AND f.rcpt_date <  %({p}end_date)s
+{indent}  AND f.order_doctor = ANY(%(doctors)s)"""
+
+    if narrow:
+        live_title = "t_workload_inp_f"
+        live = f"""
+  SELECT
+    f.rcpt_date,
+    SUM(f.costs)::numeric    AS costs
+  FROM t_workload_inp_f f{live_where("  ")}
+  GROUP BY
+    f.rcpt_date"""
+        hist_cols = ""
+        hist_group = "f.billing_date"
+        amount = ""
+    else:
+        # 先在事实表上按 日期+工号+项目类 聚合，再关联姓名；
+        # 姓名只取所选工号、每个工号一行：工号挂在多个科室时不会把收入放大
+        live_title = "t_workload_inp_f + 所选工号的姓名"
+        live = f"""
+  SELECT
+    f.rcpt_date,
+    f.doc_code,
+    dn.doc_name,
+    f.item_class_name,
+    f.costs,
+    f.amount
+  FROM (
+    SELECT
+      f.rcpt_date,
+      f.order_doctor::text     AS doc_code,
+      f.item_class_name::text  AS item_class_name,
+      SUM(f.costs)::numeric    AS costs,
+      SUM(f.amount)::numeric   AS amount
+    FROM t_workload_inp_f f{live_where("    ")}
+    GROUP BY
+      f.rcpt_date,
+      f.order_doctor,
+      f.item_class_name
+  ) f
+  LEFT JOIN (
+    SELECT
+      d."工号"               AS doc_code,
+      MIN(d."姓名")::text    AS doc_name
+    FROM t_workload_doc_2dep_def d
+    WHERE d."工号" = ANY(%(doctors)s)
+    GROUP BY d."工号"
+  ) dn
+    ON dn.doc_code = f.doc_code"""
+        hist_cols = """
+    f.doc_code::text         AS doc_code,
+    f.doc_name::text         AS doc_name,
+    f.item_class_name::text  AS item_class_name,"""
+        hist_group = """f.billing_date,
+    f.doc_code,
+    f.doc_name,
+    f.item_class_name"""
+        amount = """,
+    SUM(f.amount)::numeric   AS amount"""
+    return f"""
+{name} AS NOT MATERIALIZED (
+  ----------------------------------------------------------------
+  -- 1. 实时：{live_title}
+  ----------------------------------------------------------------{live}
+
+  UNION ALL
+
+  ----------------------------------------------------------------
+  -- 2. 历史：t_doc_fee_inp
+  ----------------------------------------------------------------
+  SELECT
+    f.billing_date::date     AS rcpt_date,{hist_cols}
+    SUM(f.costs)::numeric    AS costs{amount}
+  FROM t_doc_fee_inp f
+  WHERE
+    f.billing_date >= %({p}start_date)s
+    AND f.billing_date <  %({p}end_date)s
+    AND f.doc_code = ANY(%(doctors)s)
+  GROUP BY
+    {hist_group}
+)"""
+
+
+def _bed_cte(
+    name: str = "bed_raw",
+    p: str = "",
+    phase: str = "mixed",
+    deps: bool = True,
+) -> str:
+    """
+    床日 CTE，一条语句里要取多个区间时用不同的 name / 参数前缀。
+    实时登记表按整个区间查；区间从今天开始（live）时历史表没有数据，不拼。
+    只用于按日透视：各分支先各自按日期聚合，每天最多一行，外层合并的行数最少。
+    """
+    live = f"""
+  -- 实时
+  SELECT
+    r.adm_date         AS dt,
+    COUNT(r.mdtrt_id)  AS bed_cnt
+  FROM t_workload_inbed_reg_f r
+  WHERE r.adm_date >= %({p}start_date)s
+    AND r.adm_date <  %({p}end_date)s{_dep_filter("r.adm_dept_code", deps, "    ")}
+  GROUP BY r.adm_date"""
+    hist = f"""
+  -- 历史物化视图
+  SELECT
+    b.inbed_date::date AS dt,
+    SUM(b.amount)      AS bed_cnt
+  FROM t_dep_count_inbed b
+  WHERE b.inbed_date >= %({p}start_date)s
+    AND b.inbed_date <  %({p}hist_end)s{_dep_filter("b.dep_code", deps, "    ")}
+  GROUP BY b.inbed_date::date"""
+    legs = live if phase == "live" else f"{live}\n  UNION ALL{hist}"
+    return f"""
+{name} AS NOT MATERIALIZED ({legs}
+)"""
+
+
+def _dep_detail_select(deps: bool) -> str:
+    """
+    科室模式收入明细，在库里按明细粒度分组：
+    - 无科室：日期 + 科室名称（项目类统一为 NULL）
+    - 有科室：日期 + 科室名称 + 项目类
+    同一科室名称对应多个编码时取最小编码
+    """
+    item_class = "item_class_name" if deps else "NULL::text AS item_class_name"
+    group_item = ",\n  item_class_name" if deps else ""
+    return f"""SELECT
+  rcpt_date,
+  MIN(dep_code)              AS dep_code,
+  dep_name,
+  {item_class},
+  COALESCE(SUM(charges), 0)  AS charges,
+  COALESCE(SUM(amount), 0)   AS amount
+FROM dep_incom
+GROUP BY
+  rcpt_date,
+  dep_name{group_item}"""
+
+
+def _dep_detail_order(deps: bool) -> str:
+    """明细展示顺序（COLLATE "C" 即按码位，与前端拿到的顺序一致）"""
+    order_item = ',\n  item_class_name COLLATE "C" NULLS FIRST' if deps else ""
+    return f"""ORDER BY
+  rcpt_date,
+  dep_name COLLATE "C" NULLS FIRST{order_item}"""
+
+
+# 分页取明细：一页 + 按日汇总（合计 / 按日收入 / 总条数）两条语句配合使用
+_PAGE_CLAUSE = "LIMIT %(limit)s OFFSET %(offset)s"
+
+
+def _sql_daily_from_detail(detail_select: str, value: str) -> str:
+    """按日汇总明细分组：当日收入、当日明细条数"""
+    return f"""SELECT
+  rcpt_date,
+  SUM({value})  AS {value},
+  COUNT(*)      AS groups
+FROM (
+{detail_select}
+) g
+GROUP BY rcpt_date"""
+
+
+def _sql_dep_income_rows(phase: str, deps: bool, kind: str = "rows") -> str:
+    """
+    kind：rows 全部明细 / page 一页明细 / daily 按日汇总
+    """
+    if kind == "daily":
+        body = _sql_daily_from_detail(_dep_detail_select(deps), "charges")
+    else:
+        body = f"{_dep_detail_select(deps)}\n{_dep_detail_order(deps)}"
+        if kind == "page":
+            body += f"\n{_PAGE_CLAUSE}"
+    return f"""
+WITH {_dep_income_cte(phase=phase, deps=deps).strip()}
+{body}
+"""
+
+
+# 医生模式收入明细：日期 + 工号 + 项目类 分组，姓名取排序最前的一个
+_DOC_DETAIL_SELECT = """SELECT
+  rcpt_date,
+  doc_code,
+  MIN(doc_name)              AS doc_name,
+  item_class_name,
+  COALESCE(SUM(costs), 0)    AS costs,
+  COALESCE(SUM(amount), 0)   AS amount
+FROM doc_income
+GROUP BY
+  rcpt_date,
+  doc_code,
+  item_class_name"""
+
+_DOC_DETAIL_ORDER = """ORDER BY
+  rcpt_date,
+  doc_code COLLATE "C" NULLS FIRST,
+  item_class_name COLLATE "C" NULLS FIRST"""
+
+_DOC_INCOME_WITH = f"WITH {_doc_income_cte().strip()}"
+
+_SQL_DOC_INCOME_ROWS = f"""
+{_DOC_INCOME_WITH}
+{_DOC_DETAIL_SELECT}
+{_DOC_DETAIL_ORDER}
+"""
+
+_SQL_DOC_INCOME_PAGE = f"""
+{_DOC_INCOME_WITH}
+{_DOC_DETAIL_SELECT}
+{_DOC_DETAIL_ORDER}
+{_PAGE_CLAUSE}
+"""
+
+_SQL_DOC_INCOME_DAILY = f"""
+{_DOC_INCOME_WITH}
+{_sql_daily_from_detail(_DOC_DETAIL_SELECT, "costs")}
+"""
+
+
+# 按日透视：去年同期收入/床日 + 当期床日 + 上周期收入/床日，一次聚合取回
+# （各自按自己的日期分组；去年同日的对齐在 Python 里做，闰日好处理；
+#   上周期只用于环比合计，在 Python 里求和）
+_SQL_PIVOT_BODY = """
+SELECT
+  dt,
+  SUM(v) FILTER (WHERE k = 'rev_ly')   AS rev_ly,
+  SUM(v) FILTER (WHERE k = 'bed_cur')  AS bed_cur,
+  SUM(v) FILTER (WHERE k = 'bed_ly')   AS bed_ly,
+  SUM(v) FILTER (WHERE k = 'rev_prev') AS rev_prev,
+  SUM(v) FILTER (WHERE k = 'bed_prev') AS bed_prev
+FROM (
+  {rev_ly}
+  UNION ALL
+  {rev_prev}
+  UNION ALL
+  SELECT dt, 'bed_cur' AS k, COALESCE(bed_cnt, 0) AS v FROM bed_cur
+  UNION ALL
+  SELECT dt, 'bed_ly' AS k, COALESCE(bed_cnt, 0) AS v FROM bed_ly
+  UNION ALL
+  SELECT dt, 'bed_prev' AS k, COALESCE(bed_cnt, 0) AS v FROM bed_prev
+) u
+GROUP BY dt
+ORDER BY dt
+"""
+
+
+def _sql_dep_daily_pivot(phase: str, ly_phase: str, prev_phase: str, deps: bool) -> str:
+    def rev_leg(k: str, p: str) -> str:
+        return f"SELECT rcpt_date AS dt, '{k}' AS k, COALESCE(charges, 0) AS v FROM inc_{p[:-1]}"
+
+    return f"""
+WITH {_dep_income_cte("ly_", ly_phase, deps, "inc_ly", narrow=True).strip()},
+{_dep_income_cte("prev_", prev_phase, deps, "inc_prev", narrow=True).strip()},
+{_bed_cte("bed_cur", phase=phase, deps=deps).strip()},
+{_bed_cte("bed_ly", "ly_", ly_phase, deps).strip()},
+{_bed_cte("bed_prev", "prev_", prev_phase, deps).strip()}
+""" + _SQL_PIVOT_BODY.format(
+        rev_ly=rev_leg("rev_ly", "ly_"),
+        rev_prev=rev_leg("rev_prev", "prev_"),
+    )
+
+
+def _sql_doc_daily_pivot(phase: str, ly_phase: str, prev_phase: str, deps: bool) -> str:
+    return f"""
+WITH {_doc_income_cte("ly_", "inc_ly", narrow=True).strip()},
+{_doc_income_cte("prev_", "inc_prev", narrow=True).strip()},
+{_bed_cte("bed_cur", phase=phase, deps=deps).strip()},
+{_bed_cte("bed_ly", "ly_", ly_phase, deps).strip()},
+{_bed_cte("bed_prev", "prev_", prev_phase, deps).strip()}
+""" + _SQL_PIVOT_BODY.format(
+        rev_ly="SELECT rcpt_date AS dt, 'rev_ly' AS k, COALESCE(costs, 0) AS v FROM inc_ly",
+        rev_prev="SELECT rcpt_date AS dt, 'rev_prev' AS k, COALESCE(costs, 0) AS v FROM inc_prev",
+    )
+
+
+_DEPS_ARG = (("departments", "text[]"), ("his_codes", "text[]"))
+_DOCS_ARG = (("doctors", "text[]"),)
+_PAGE_ARGS = (("limit", "bigint"), ("offset", "bigint"))
+_PIVOT_ARGS = _window_args() + _window_args("ly_") + _window_args("prev_") + _DEPS_ARG
+
+# 各语句按 区间位置（hist / live / mixed）× 是否按科室过滤 在导入时各建一份，
+# 运行时按参数挑选；透视语句带三个区间，按 (当期, 去年同期, 上周期) 组合建
+_DEP_FLAGS = (False, True)
+_VARIANTS = [(ph, d) for ph in _PHASES for d in _DEP_FLAGS]
+_PIVOT_VARIANTS = [
+    (ph, ly, prev, d)
+    for ph in _PHASES
+    for ly in _PHASES
+    for prev in _PHASES
+    for d in _DEP_FLAGS
+]
+
+
+def _variant_name(*parts) -> str:
+    return "_".join(
+        ("deps" if x else "all") if isinstance(x, bool) else str(x) for x in parts
+    )
+
+
+_STMT_DEP_DOC_MAP = _Statement("itr_dep_doc_map", _SQL_DEP_DOC_MAP)
+_STMT_HIS_DEP_MAP = _Statement("itr_his_dep_map", _SQL_HIS_DEP_MAP)
+_STMT_DEP_INCOME_ROWS = {
+    v: _Statement(
+        _variant_name("itr_dep_income_rows", *v),
+        _sql_dep_income_rows(*v),
+        _window_args() + _DEPS_ARG,
+    )
+    for v in _VARIANTS
+}
+_STMT_DEP_INCOME_PAGE = {
+    v: _Statement(
+        _variant_name("itr_dep_income_page", *v),
+        _sql_dep_income_rows(*v, kind="page"),
+        _window_args() + _DEPS_ARG + _PAGE_ARGS,
+    )
+    for v in _VARIANTS
+}
+_STMT_DEP_INCOME_DAILY = {
+    v: _Statement(
+        _variant_name("itr_dep_income_daily", *v),
+        _sql_dep_income_rows(*v, kind="daily"),
+        _window_args() + _DEPS_ARG,
+    )
+    for v in _VARIANTS
+}
+_STMT_DOC_INCOME_ROWS = _Statement(
+    "itr_doc_income_rows", _SQL_DOC_INCOME_ROWS, _window_args() + _DOCS_ARG
+)
+_STMT_DOC_INCOME_PAGE = _Statement(
+    "itr_doc_income_page", _SQL_DOC_INCOME_PAGE, _window_args() + _DOCS_ARG + _PAGE_ARGS
+)
+_STMT_DOC_INCOME_DAILY = _Statement(
+    "itr_doc_income_daily", _SQL_DOC_INCOME_DAILY, _window_args() + _DOCS_ARG
+)
+# 收入明细语句：kind -> (科室模式各变体, 医生模式)
+#   rows ：全部明细
+#   page ：一页明细（参数 limit / offset）
+#   daily：按日汇总（当日收入、当日明细条数），分页时给合计 / 时间序列 / 总条数用
+_INCOME_STMTS = {
+    "rows": (_STMT_DEP_INCOME_ROWS, _STMT_DOC_INCOME_ROWS),
+    "page": (_STMT_DEP_INCOME_PAGE, _STMT_DOC_INCOME_PAGE),
+    "daily": (_STMT_DEP_INCOME_DAILY, _STMT_DOC_INCOME_DAILY),
+}
+_STMT_DEP_DAILY_PIVOT = {
+    v: _Statement(
+        _variant_name("itr_dep_daily_pivot", *v),
+        _sql_dep_daily_pivot(*v),
+        _PIVOT_ARGS,
+    )
+    for v in _PIVOT_VARIANTS
+}
+_STMT_DOC_DAILY_PIVOT = {
+    v: _Statement(
+        _variant_name("itr_doc_daily_pivot", *v),
+        _sql_doc_daily_pivot(*v),
+        _PIVOT_ARGS + _DOCS_ARG,
+    )
+    for v in _PIVOT_VARIANTS
+}
+
+
 # ========== Repository ==========
 
 class InpatientTotalRevenueRepository:
@@ -113,19 +749,158 @@ class InpatientTotalRevenueRepository:
       - get_full_revenue：统一返回 summary + timeseries + details
     """
 
+    # 连接 -> 该会话上已 PREPARE 的语句名；连接被池关闭/替换后条目随之失效
+    _prepared: "weakref.WeakKeyDictionary[Any, set]" = weakref.WeakKeyDictionary()
+    _prepared_lock = threading.Lock()
+
     # ------ 通用 DB 工具方法 ------
 
-    def _query_rows(self, sql: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
-        conn = get_conn()
+    def _execute(self, conn, cur, stmt: _Statement, params: Dict[str, Any]) -> None:
+        """
+        以 EXECUTE 方式执行预备语句；该连接首次遇到此语句时先 PREPARE。
+        会话被重置（语句丢失 / 已存在）时回滚并重新登记，只重试一次。
+        """
+        with self._prepared_lock:
+            names = self._prepared.setdefault(conn, set())
+
+        if stmt.name not in names:
+            try:
+                cur.execute(stmt.prepare_sql)
+            except errors.DuplicatePreparedStatement:
+                conn.rollback()
+            names.add(stmt.name)
+
+        logger.debug("Executing SQL: %s | params=%s", stmt.name, params)
         try:
-            with conn.cursor() as cur:
-                logger.debug("Executing SQL: %s | params=%s", sql, params)
-                cur.execute(sql, params)
-                cols = [c[0] for c in cur.description]
-                raw = cur.fetchall()
-            return [{k: _prim_for_json(v) for k, v in zip(cols, row)} for row in raw]
+            cur.execute(stmt.execute_sql, params)
+        except errors.InvalidSqlStatementName:
+            conn.rollback()
+            cur.execute(stmt.prepare_sql)
+            cur.execute(stmt.execute_sql, params)
+
+    def _fetch_table(
+        self,
+        conn,
+        stmt: _Statement,
+        params: Dict[str, Any],
+        stream: bool = False,
+    ) -> Tuple[List[str], List[tuple]]:
+        """
+        执行语句，返回 (列名, 元组行)。
+        NUMERIC 由 use_float_numeric 注册在本游标上的 DEC2FLOAT 类型转换器
+        在解析时直接产出 float；该转换器只作用于这个游标（非全局注册），
+        其他模块的查询拿到的仍是 Decimal。日期保持 date 对象，取回后不再逐格转换。
+        """
+        if stream:
+            return self._stream_table(conn, stmt, params)
+
+        with conn.cursor() as cur:
+            use_float_numeric(cur)
+            self._execute(conn, cur, stmt, params)
+            cols = [c[0] for c in cur.description]
+            raw = cur.fetchall()
+        return cols, raw
+
+    def _stream_table(
+        self, conn, stmt: _Statement, params: Dict[str, Any]
+    ) -> Tuple[List[str], List[tuple]]:
+        """
+        大结果集：命名（服务端）游标，每次 fetchmany 取 STREAM_ITERSIZE 行。
+        DECLARE ... CURSOR FOR 不能接 EXECUTE，这里直接发原始 SQL。
+        只省掉 libpq 一次性缓存整个结果集的那份内存：各批仍追加到同一个
+        元组列表里返回，Python 侧照样持有全部行（并非边取边处理）。
+        """
+        rows: List[tuple] = []
+        with conn.cursor(name=f"itr_{uuid.uuid4().hex}") as cur:
+            use_float_numeric(cur)
+            logger.debug("Streaming SQL: %s | params=%s", stmt.name, params)
+            cur.execute(stmt.sql, params)
+            # 命名游标首次取数后才有 description
+            chunk = cur.fetchmany(STREAM_ITERSIZE)
+            cols = [c[0] for c in cur.description]
+            # 各批都并进同一个列表：Python 侧峰值内存仍是整个结果集
+            while chunk:
+                rows.extend(chunk)
+                chunk = cur.fetchmany(STREAM_ITERSIZE)
+        return cols, rows
+
+    def _query_rows(self, stmt: _Statement, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        with get_db_connection() as conn:
+            cols, rows = self._fetch_table(conn, stmt, params)
+        return [dict(zip(cols, row)) for row in rows]
+
+    def _query_batch(
+        self,
+        plans: List[Tuple[Optional[_Statement], Dict[str, Any]]],
+        stream: Tuple[int, ...] = (),
+    ) -> List[Tuple[List[str], List[tuple]]]:
+        """
+        一次借出连接，顺序执行多条语句，按顺序返回各自的 (列名, 元组行)。
+        一次请求内的多条查询共用同一个连接，省掉重复的借还、校验与 SET 往返。
+        stream：需要走服务端游标的语句下标（预计结果集较大的）；
+        只免去 libpq 在客户端一次缓存整个结果集，不降低 Python 侧内存。
+        语句为 None 表示结果已知为空，不发往数据库。
+        """
+        with get_db_connection() as conn:
+            return [
+                self._fetch_table(conn, stmt, params, stream=i in stream)
+                if stmt is not None
+                else ([], [])
+                for i, (stmt, params) in enumerate(plans)
+            ]
+
+    def _query_table(
+        self, stmt: _Statement, params: Dict[str, Any], stream: bool = False
+    ) -> Tuple[List[str], List[tuple]]:
+        """单条语句单独借一个连接执行，供并发查询使用"""
+        with get_db_connection() as conn:
+            return self._fetch_table(conn, stmt, params, stream=stream)
+
+    def _query_parallel(
+        self,
+        plans: List[Tuple[Optional[_Statement], Dict[str, Any]]],
+        stream: Tuple[int, ...] = (),
+    ) -> List[Tuple[List[str], List[tuple]]]:
+        """
+        与 _query_batch 相同的入参/返回。第一条语句之外，能拿到后台名额
+        （见 _fanout_semaphore）的语句各借一个连接提交到 _query_executor 并发执行；
+        拿不到名额的和第一条一起在调用线程上用一个连接顺序执行。
+        名额全被占用（并发请求多）或实际要查的语句不足两条时，
+        等同于 _query_batch：一个请求只占一个连接。
+        出错时先等后台语句结束、连接归还：调用线程的异常优先原样抛出，
+        否则按语句顺序抛出第一个后台异常。
+        """
+        jobs = [
+            (i, stmt, params)
+            for i, (stmt, params) in enumerate(plans)
+            if stmt is not None
+        ]
+        slots = _fanout_semaphore()
+        local = jobs[:1]
+        futures = []
+        for i, stmt, params in jobs[1:]:
+            if not slots.acquire(blocking=False):
+                local.append((i, stmt, params))
+                continue
+            fut = _query_executor.submit(self._query_table, stmt, params, i in stream)
+            fut.add_done_callback(lambda _f: slots.release())
+            futures.append((i, fut))
+        if not futures:
+            return self._query_batch(plans, stream=stream)
+
+        results: List[Tuple[List[str], List[tuple]]] = [([], [])] * len(plans)
+        try:
+            batch = self._query_batch(
+                [(stmt, params) for _, stmt, params in local],
+                stream=tuple(k for k, (i, _, _) in enumerate(local) if i in stream),
+            )
+            for (i, _, _), res in zip(local, batch):
+                results[i] = res
         finally:
-            put_conn(conn)
+            wait([fut for _, fut in futures])
+        for i, fut in futures:
+            results[i] = fut.result()
+        return results
 
     # ------ 科室 → 医生 映射 ------
 
@@ -146,50 +921,59 @@ class InpatientTotalRevenueRepository:
           ...
         ]
         """
-        sql = """
-        SELECT
-          d."绩效科室ID"   AS dep_id,
-          d."绩效科室名称" AS dep_name,
-          JSON_AGG(DISTINCT jsonb_build_object(
-            'doc_id',   d."工号",
-            'doc_name', d."姓名"
-          )) AS doctors
-        FROM t_workload_doc_2dep_def d
-        WHERE
-          d."工号" IS NOT NULL
-          AND d."工号" <> ''
-          AND d."姓名" IS NOT NULL
-          AND d."姓名" <> ''
-          AND d."绩效科室ID" IS NOT NULL
-          AND d."绩效科室ID" <> ''
-          AND d."绩效科室名称" IS NOT NULL
-          AND d."绩效科室名称" <> ''
-        GROUP BY
-          d."绩效科室ID",
-          d."绩效科室名称"
-        ORDER BY
-          d."绩效科室ID";
-        """
-        rows = self._query_rows(sql, {})
-        # 如果想按工号排序，可以在 Python 再排一下
-        for r in rows:
-            docs = r.get("doctors") or []
-            r["doctors"] = sorted(
-                docs,
-                key=lambda x: str((x or {}).get("doc_id") or "")
-            )
+        cached = cache_get(DEP_DOC_MAP_CACHE_KEY)
+        if cached is not None:
+            return cached
+
+        # doctors 已在物化视图里按工号排好
+        rows = self._query_rows(_STMT_DEP_DOC_MAP, {})
+
+        cache_set(DEP_DOC_MAP_CACHE_KEY, rows, ttl_seconds=DEP_DOC_MAP_TTL_SECONDS)
         return rows
 
+    @staticmethod
+    def invalidate_dep_doc_map() -> None:
+        """
+        映射表（医生-科室 / 科室-HIS 编码）有人工维护后调用：
+        丢掉进程内缓存（含当天 /init 响应体），下次请求直接读库，不必等 TTL 过期
+        """
+        cache_clear(DEP_DOC_MAP_CACHE_KEY)
+        cache_clear(HIS_DEP_MAP_CACHE_KEY)
+        cache_clear(init_cache_key(date.today()))
+
+    # ------ 绩效科室名称 -> HIS 科室编码 ------
+
+    def _his_codes(self, deps: Optional[List[str]]) -> Optional[List[str]]:
+        """
+        把绩效科室名称解析成 HIS 科室编码（实时事实表按编码过滤）。
+        无科室过滤时返回 None；有科室但一个编码都没映射到时返回 []。
+        """
+        if not deps:
+            return None
+
+        pairs = cache_get(HIS_DEP_MAP_CACHE_KEY)
+        if pairs is None:
+            pairs = [
+                (r["his_code"], r["dep_name"])
+                for r in self._query_rows(_STMT_HIS_DEP_MAP, {})
+            ]
+            cache_set(HIS_DEP_MAP_CACHE_KEY, pairs, ttl_seconds=HIS_DEP_MAP_TTL_SECONDS)
+
+        wanted = set(deps)
+        return sorted({code for code, name in pairs if name in wanted})
+
     # ------ 科室模式基础数据（历史 + 实时） ------
 
-    def _query_dep_income_rows(
+    def _dep_income_plan(
         self,
         start: date,
         end: date,
         departments=None,
-    ) -> List[Dict[str, Any]]:
+        today: Optional[date] = None,
+        kind: str = "rows",
+    ) -> Tuple[Optional[_Statement], Dict[str, Any]]:
         """
-        科室模式基础收入数据：
+        科室模式基础收入数据（kind 见 _INCOME_STMTS）：
         - 历史：t_dep_income_inp
         - 当日实时：t_workload_inp_f + t_workload_dep_def2his
         统一输出字段：
@@ -200,84 +984,30 @@ class InpatientTotalRevenueRepository:
         - charges
         - amount
         """
+        today = today or date.today()
         deps = _norm_deps(departments)
-        params: Dict[str, Any] = {
-            "start_date": start,
-            "end_date": end,
-            "departments": deps,
-        }
-        sql = """
-        WITH dep_incom AS (
-            ----------------------------------------------------------------
-            -- 历史部门收入：t_dep_income_inp
-            ----------------------------------------------------------------
-            SELECT
-              x.rcpt_date::date        AS rcpt_date,
-              x.dep_code::text         AS dep_code,
-              x.dep_name::text         AS dep_name,
-              x.item_class_name::text  AS item_class_name,
-              x.charges::numeric       AS charges,
-              x.amount::numeric        AS amount
-            FROM t_dep_income_inp x
-            WHERE
-              x.rcpt_date < CURRENT_DATE
-              AND (
-                %(departments)s IS NULL
-                OR x.dep_name = ANY(%(departments)s)
-              )
-
-            UNION ALL
-
-            ----------------------------------------------------------------
-            -- 当日实时部门收入：t_workload_inp_f + t_workload_dep_def2his
-            ----------------------------------------------------------------
-            SELECT
-              f.rcpt_date::date        AS rcpt_date,
-              f.patient_in_dept::text  AS dep_code,
-              d."绩效科室名称"::text    AS dep_name,
-              f.item_class_name::text  AS item_class_name,
-              SUM(f.charges)::numeric  AS charges,
-              SUM(f.amount)::numeric   AS amount
-            FROM t_workload_inp_f f
-            LEFT JOIN t_workload_dep_def2his d
-              ON d."HIS科室编码"::text = f.patient_in_dept::text
-            WHERE
-              f.rcpt_date >= CURRENT_DATE
-              AND f.rcpt_date <  CURRENT_DATE + 1
-              AND (
-                %(departments)s IS NULL
-                OR d."绩效科室名称" = ANY(%(departments)s)
-              )
-            GROUP BY
-              f.rcpt_date,
-              f.patient_in_dept,
-              d."绩效科室名称",
-              f.item_class_name
-        )
-        SELECT
-          rcpt_date,
-          dep_code,
-          dep_name,
-          item_class_name,
-          charges,
-          amount
-        FROM dep_incom
-        WHERE
-          rcpt_date >= %(start_date)s
-          AND rcpt_date <  %(end_date)s;
-        """
-        return self._query_rows(sql, params)
+        params = _window_params(start, end, today)
+        params["departments"] = deps
+        params["his_codes"] = self._his_codes(deps)
+        phase = _window_phase(start, end, today)
+        if params["his_codes"] == []:
+            phase = _without_live_income(phase)
+            if phase is None:
+                return None, params
+        return _INCOME_STMTS[kind][0][(phase, bool(deps))], params
 
     # ------ 医生模式基础数据（历史 + 实时） ------
 
-    def _query_doc_income_rows(
+    def _doc_income_plan(
         self,
         start: date,
         end: date,
         doctors=None,
-    ) -> List[Dict[str, Any]]:
+        today: Optional[date] = None,
+        kind: str = "rows",
+    ) -> Tuple[_Statement, Dict[str, Any]]:
         """
-        医生模式基础数据（历史 + 实时）：
+        医生模式基础数据（历史 + 实时，kind 见 _INCOME_STMTS）：
 
         约定：
         - 只按医生工号过滤（前端把 doc_id 传进来）
@@ -285,125 +1015,53 @@ class InpatientTotalRevenueRepository:
         - 统一输出字段：
             rcpt_date, doc_code, doc_name, item_class_name, costs, amount
         """
-        docs = _norm_docs(doctors)
-        params: Dict[str, Any] = {
-            "start_date": start,
-            "end_date": end,
-            "doctors": docs,
-        }
-        sql = """
-        WITH doc_income AS (
-          ----------------------------------------------------------------
-          -- 1. 实时：t_workload_inp_f
-          ----------------------------------------------------------------
-          SELECT 
-            f.rcpt_date::date        AS rcpt_date,
-            f.order_doctor::text     AS doc_code,
-            d."姓名"::text           AS doc_name,
-            f.item_class_name::text  AS item_class_name,
-            SUM(f.costs)::numeric    AS costs,
-            SUM(f.amount)::numeric   AS amount
-          FROM t_workload_inp_f f
-          LEFT JOIN t_workload_doc_2dep_def d 
-            ON f.order_doctor = d."工号"
-          WHERE 
-            f.rcpt_date >= %(start_date)s
-            AND f.rcpt_date <  %(end_date)s
-            AND (
-                %(doctors)s IS NULL
-                OR f.order_doctor = ANY(%(doctors)s)
-            )
-          GROUP BY 
-            f.rcpt_date,
-            f.order_doctor,
-            d."姓名",
-            f.item_class_name
-
-          UNION ALL
-
-          ----------------------------------------------------------------
-          -- 2. 历史：t_doc_fee_inp
-          ----------------------------------------------------------------
-          SELECT
-            f.billing_date::date     AS rcpt_date,
-            f.doc_code::text         AS doc_code,
-            f.doc_name::text         AS doc_name,
-            f.item_class_name::text  AS item_class_name,
-            SUM(f.costs)::numeric    AS costs,
-            SUM(f.amount)::numeric   AS amount
-          FROM t_doc_fee_inp f
-          WHERE
-            f.billing_date >= %(start_date)s
-            AND f.billing_date <  %(end_date)s
-            AND (
-                %(doctors)s IS NULL
-                OR f.doc_code = ANY(%(doctors)s)
-            )
-          GROUP BY
-            f.billing_date,
-            f.doc_code,
-            f.doc_name,
-            f.item_class_name
-        )
-        SELECT 
-          rcpt_date,
-          doc_code,
-          doc_name,
-          item_class_name,
-          costs,
-          amount
-        FROM doc_income
-        ORDER BY rcpt_date, doc_code, item_class_name;
-        """
-        return self._query_rows(sql, params)
+        params = _window_params(start, end, today or date.today())
+        params["doctors"] = _norm_docs(doctors)
+        return _INCOME_STMTS[kind][1], params
 
-    # ------ 床日（按日期聚合） ------
+    # ------ 按日透视：去年同期 / 上周期收入 + 各区间床日 ------
 
-    def _query_bed_by_date(
+    def _daily_pivot_plan(
         self,
         start: date,
         end: date,
+        ly_start: date,
+        ly_end: date,
+        prev_start: date,
         departments=None,
-    ) -> List[Dict[str, Any]]:
+        doctors=None,
+        today: Optional[date] = None,
+    ) -> Tuple[_Statement, Dict[str, Any]]:
         """
-        床日按日期聚合：
-        - 实时：t_workload_inbed_reg_f
-        - 历史：t_dep_count_inbed
+        每日一行：dt, rev_ly, bed_cur, bed_ly, rev_prev, bed_prev
+        - rev_ly / rev_prev：去年同期 / 上周期收入（有 doctors 取 costs，否则取 charges）
+        - bed_*：床日（实时 t_workload_inbed_reg_f + 历史 t_dep_count_inbed）
+        上周期为 [prev_start, start)；各列都按各自区间的日期分组
         """
+        today = today or date.today()
+        docs = _norm_docs(doctors)
+        params = _window_params(start, end, today)
+        params.update(_window_params(ly_start, ly_end, today, "ly_"))
+        params.update(_window_params(prev_start, start, today, "prev_"))
         deps = _norm_deps(departments)
-        params: Dict[str, Any] = {"start": start, "end": end, "deps": deps}
-        sql = """
-        WITH bed_raw AS (
-          -- 实时
-          SELECT
-            r.adm_date::date   AS dt,
-            r.adm_dept_code    AS dep_code,
-            COUNT(r.mdtrt_id)  AS bed_cnt
-          FROM t_workload_inbed_reg_f r
-          WHERE r.adm_date >= %(start)s
-            AND r.adm_date <  %(end)s
-            AND (%(deps)s IS NULL OR r.adm_dept_code = ANY(%(deps)s))
-          GROUP BY 1,2
-          UNION ALL
-          -- 历史物化视图
-          SELECT
-            b.inbed_date::date AS dt,
-            b.dep_code,
-            b.amount           AS bed_cnt
-          FROM t_dep_count_inbed b
-          WHERE b.inbed_date >= %(start)s
-            AND b.inbed_date <  %(end)s
-            AND b.inbed_date < CURRENT_DATE
-            AND (%(deps)s IS NULL OR b.dep_code = ANY(%(deps)s))
+        params["departments"] = deps
+        params["his_codes"] = None if docs else self._his_codes(deps)
+        ly_phase = _window_phase(ly_start, ly_end, today)
+        prev_phase = _window_phase(prev_start, start, today)
+        if params["his_codes"] == []:
+            # 只有 mixed 可退化；live 区间仍按原语句查（收入为空，床日照常）
+            ly_phase = _without_live_income(ly_phase) or ly_phase
+            prev_phase = _without_live_income(prev_phase) or prev_phase
+        variant = (
+            _window_phase(start, end, today),
+            ly_phase,
+            prev_phase,
+            bool(deps),
         )
-        SELECT
-          dt::date       AS date,
-          SUM(bed_cnt)   AS bed_days
-        FROM bed_raw
-        GROUP BY dt
-        ORDER BY dt;
-        """
-        return self._query_rows(sql, params)
+        if docs:
+            params["doctors"] = docs
+            return _STMT_DOC_DAILY_PIVOT[variant], params
+        return _STMT_DEP_DAILY_PIVOT[variant], params
 
     # ------ 统一出口：summary + timeseries + details ------
 
@@ -413,12 +1071,16 @@ class InpatientTotalRevenueRepository:
         end: Optional[date] = None,
         departments=None,
         doctors=None,
+        limit: Optional[int] = None,
+        offset: int = 0,
     ) -> Dict[str, Any]:
         """
         统一查询入口：
 
         - 如果有 doctors（医生工号列表），走“医生模式”（忽略部门）
         - 否则走“科室模式”（按部门名称过滤）
+        - 给了 limit 时 details 只返回 [offset, offset + limit) 这一页（在 SQL 里分页），
+          summary / timeseries / total 仍按整个区间计算
 
         返回：
         {
@@ -428,7 +1090,7 @@ class InpatientTotalRevenueRepository:
           "summary": {...},        # 含 当前收入/床日 + 同比/环比
           "timeseries": [...],     # 每日收入/床日 + 同比/环比
           "details": [...],
-          "total": <明细条数>
+          "total": <明细总条数>
         }
         """
         if end is None:
@@ -440,61 +1102,143 @@ class InpatientTotalRevenueRepository:
         deps = _norm_deps(departments)
         docs = _norm_docs(doctors)
 
-        # ---------- 1）当前区间基础数据 ----------
-        if docs:
-            mode = "doctor"
-            base_rows_cur = self._query_doc_income_rows(start, end, docs)
-            base_rows_prev = self._query_doc_income_rows(
-                start - (end - start), start, docs
-            )
-            # 去年同期：start/end 往前平移一年
-            last_start = _shift_year(start, -1)
-            last_end = _shift_year(end, -1)
-            base_rows_last = self._query_doc_income_rows(
-                last_start, last_end, docs
+        paged = limit is not None
+        if paged:
+            limit = max(int(limit), 0)
+            offset = max(int(offset or 0), 0)
+
+        # 历史/实时分界：整次请求用同一个“今天”
+        today = date.today()
+
+        # 科室模式、区间全部在今天之前：直接用缓存结果（缓存范围见 HIST_RESULT_CACHE_PREFIX 处说明）
+        cache_key = None
+        if end <= today and not docs and not (paged and offset):
+            cache_key = (
+                f"{HIST_RESULT_CACHE_PREFIX}:{start.isoformat()}:{end.isoformat()}"
+                f":{tuple(deps or ())}:{limit}"
             )
+            cached = cache_get(cache_key)
+            if cached is not None:
+                return copy.deepcopy(cached)
+
+        # ---------- 1）收入 + 床日：当前 / 上周期 / 去年同期 ----------
+        # 当期收入明细一条；其余（去年同期 / 上周期收入、三段床日）合成一条按日透视
+        # 医生模式按工号取收入（忽略部门），科室模式按部门名称取收入
+        mode = "doctor" if docs else "department"
+        income_plan = self._doc_income_plan if docs else self._dep_income_plan
+        income_filter = docs if docs else deps
+
+        prev_start = start - (end - start)
+        # 去年同期：start/end 往前平移一年
+        last_start = _shift_year(start, -1)
+        last_end = _shift_year(end, -1)
+
+        plans = [
+            income_plan(start, end, income_filter, today, "page" if paged else "rows"),
+            self._daily_pivot_plan(
+                start, end, last_start, last_end, prev_start, deps, docs, today
+            ),
+        ]
+        if paged:
+            plans[0][1].update(limit=limit, offset=offset)
+            plans.append(income_plan(start, end, income_filter, today, "daily"))
+
+        # 长区间的收入明细行数多，分批拉取（分页时只有一页，不需要）
+        stream = (0,) if not paged and (end - start).days > STREAM_MIN_DAYS else ()
+        # 收入明细与透视（分页时还有按日汇总）互不依赖，各用一个连接并发执行
+        results = self._query_parallel(plans, stream=stream)
+        # 列顺序由 SQL 固定，按位置取值：
+        #   收入明细（已按明细粒度分组）：日期, 科室/医生编码, 名称, 项目类, 收入(charges/costs), 数量
+        #   透视：dt, rev_ly, bed_cur, bed_ly, rev_prev, bed_prev
+        #   按日汇总：日期, 当日收入, 当日明细条数
+        _, base_rows_cur = results[0]
+        _, pivot_rows = results[1]
+
+        # ---------- 2）收入明细单遍处理：合计 + 按日收入 + 明细行 ----------
+        # 收入明细已在 SQL 里按明细粒度分组并排好序，这里每行直接成一条明细；
+        # 模式分支放在循环外，循环体内只做取值与累加
+
+        # 把部门名称拼好（医生模式下用于回填科室列）
+        dep_label = None
+        if deps:
+            dep_label = ",".join(deps)
+        has_deps = bool(deps)
+
+        if mode == "doctor":
+            # 有医生：日期、科室名（用筛选科室名）、医生名、项目类名、花费(costs)、数量
+            def make_detail(dt_str, doc_code, doc_name, item_class, costs, amount):
+                return {
+                    "date": dt_str,
+                    "department_name": dep_label,  # 用筛选的科室名回填
+                    "doctor_id": doc_code,
+                    "doctor_name": doc_name,
+                    "item_class_name": item_class,
+                    "cost": costs,
+                    "revenue": costs,  # 保留兼容字段
+                    "quantity": float(amount),
+                }
+        elif has_deps:
+            # 科室模式（有科室）：日期、科室名、项目类名、收入、数量
+            def make_detail(dt_str, dep_code, dep_name, item_class, charges, amount):
+                return {
+                    "date": dt_str,
+                    "department_code": dep_code,
+                    "department_name": dep_name,
+                    "revenue": charges,
+                    "item_class_name": item_class,
+                    "quantity": float(amount),
+                }
         else:
-            mode = "department"
-            base_rows_cur = self._query_dep_income_rows(start, end, deps)
-            base_rows_prev = self._query_dep_income_rows(
-                start - (end - start), start, deps
-            )
-            last_start = _shift_year(start, -1)
-            last_end = _shift_year(end, -1)
-            base_rows_last = self._query_dep_income_rows(
-                last_start, last_end, deps
-            )
+            # 科室模式（无科室）：日期、科室、收入
+            def make_detail(dt_str, dep_code, dep_name, item_class, charges, amount):
+                return {
+                    "date": dt_str,
+                    "department_code": dep_code,
+                    "department_name": dep_name,
+                    "revenue": charges,
+                }
 
-        # ---------- 2）床日：当前 / 上周期 / 去年同期 ----------
-        bed_rows_cur = self._query_bed_by_date(start, end, deps)
-        bed_rows_prev = self._query_bed_by_date(
-            start - (end - start), start, deps
-        )
-        bed_rows_last = self._query_bed_by_date(
-            last_start, last_end, deps
-        )
+        cur_rev = 0.0
+        rev_cur_by_date: Dict[date, float] = {}
+        detail_rows: List[Dict[str, Any]] = []
+        append_detail = detail_rows.append
+        # 日期列由驱动直接给 date（各分支都带日期区间条件，不会为 NULL）；
+        # 行按日期排好，ISO 字符串每个日期只生成一次
+        last_dt: Optional[date] = None
+        dt_str = ""
+        for dt, code, name, item_class, value, amount in base_rows_cur:
+            if dt != last_dt:
+                last_dt, dt_str = dt, dt.isoformat()
+            value = float(value)
+            cur_rev += value
+            rev_cur_by_date[dt] = rev_cur_by_date.get(dt, 0.0) + value
+            append_detail(make_detail(dt_str, code, name, item_class, value, amount))
+
+        total = len(detail_rows)
+        if paged:
+            # 明细只有一页：合计 / 按日收入 / 总条数改用按日汇总
+            cur_rev = 0.0
+            rev_cur_by_date = {}
+            total = 0
+            for dt, value, groups in results[2][1]:
+                value = float(value or 0.0)
+                cur_rev += value
+                rev_cur_by_date[dt] = value
+                total += groups
 
         # ---------- 3）汇总（summary） ----------
-        def sum_rev(rows: List[Dict[str, Any]]) -> float:
-            field = "costs" if mode == "doctor" else "charges"
-            s = 0.0
-            for r in rows:
-                s += float(r.get(field) or 0.0)
-            return s
-
-        def sum_bed(rows: List[Dict[str, Any]]) -> float:
+        def sum_col(rows: List[tuple], idx: int) -> float:
             s = 0.0
             for r in rows:
-                s += float(r.get("bed_days") or 0.0)
+                s += float(r[idx] or 0.0)
             return s
 
-        cur_rev = sum_rev(base_rows_cur)
-        prev_rev = sum_rev(base_rows_prev)
-        last_rev = sum_rev(base_rows_last)
+        last_rev = sum_col(pivot_rows, 1)
+        prev_rev = sum_col(pivot_rows, 4)
 
-        cur_bed = sum_bed(bed_rows_cur)
-        prev_bed = sum_bed(bed_rows_prev)
-        last_bed = sum_bed(bed_rows_last)
+        cur_bed = sum_col(pivot_rows, 2)
+        last_bed = sum_col(pivot_rows, 3)
+        prev_bed = sum_col(pivot_rows, 5)
 
         yoy = _pct_change(cur_rev, last_rev)
         mom = _pct_change(cur_rev, prev_rev)
@@ -514,39 +1258,17 @@ class InpatientTotalRevenueRepository:
 
         # ---------- 4）timeseries（每日收入 & 床日 + 同比 & 环比） ----------
 
-        from collections import defaultdict
-
-        # 当前区间
-        rev_cur_by_date: Dict[date, float] = defaultdict(float)
-        for r in base_rows_cur:
-            dt = _parse_date_str(r.get("rcpt_date") or r.get("date"))
-            if not dt:
-                continue
-            val = float(r.get("costs") or r.get("charges") or 0.0)
-            rev_cur_by_date[dt] += val
-
+        # 床日 / 去年同期：透视结果里 NULL 表示当天没有该项数据
         bed_cur_by_date: Dict[date, float] = {}
-        for r in bed_rows_cur:
-            dt = _parse_date_str(r.get("date"))
-            if not dt:
-                continue
-            bed_cur_by_date[dt] = float(r.get("bed_days") or 0.0)
-
-        # 去年同期
-        rev_last_by_date: Dict[date, float] = defaultdict(float)
-        for r in base_rows_last:
-            dt = _parse_date_str(r.get("rcpt_date") or r.get("date"))
-            if not dt:
-                continue
-            val = float(r.get("costs") or r.get("charges") or 0.0)
-            rev_last_by_date[dt] += val
-
+        rev_last_by_date: Dict[date, float] = {}
         bed_last_by_date: Dict[date, float] = {}
-        for r in bed_rows_last:
-            dt = _parse_date_str(r.get("date"))
-            if not dt:
-                continue
-            bed_last_by_date[dt] = float(r.get("bed_days") or 0.0)
+        for dt, rev_ly, bed_cur, bed_ly, _, _ in pivot_rows:
+            if bed_cur is not None:
+                bed_cur_by_date[dt] = float(bed_cur)
+            if rev_ly is not None:
+                rev_last_by_date[dt] = float(rev_ly)
+            if bed_ly is not None:
+                bed_last_by_date[dt] = float(bed_ly)
 
         all_dates = sorted(set(rev_cur_by_date.keys()) | set(bed_cur_by_date.keys()))
 
@@ -584,108 +1306,15 @@ class InpatientTotalRevenueRepository:
             prev_rev_val = rev_val
             prev_bed_val = bed_val
 
-        # ---------- 5）details（三种模式） ----------
-
-        detail_rows: List[Dict[str, Any]] = []
-
-        # 把部门名称拼好（医生模式下用于回填科室列）
-        dep_label = None
-        if deps:
-            dep_label = ",".join(deps)
-
-        if mode == "doctor":
-            # 有医生：日期、科室名（用筛选科室名）、医生名、项目类名、花费(costs)、数量
-            agg: Dict[tuple, Dict[str, Any]] = {}
-            for r in base_rows_cur:
-                dt = _parse_date_str(r.get("rcpt_date"))
-                if not dt:
-                    continue
-                dt_str = dt.isoformat()
-                doc_code = r.get("doc_code")
-                doc_name = r.get("doc_name")
-                item_class = r.get("item_class_name")
-                costs = float(r.get("costs") or 0.0)
-                amount = float(r.get("amount") or 0.0)
-
-                key = (dt_str, doc_code, item_class)
-                if key not in agg:
-                    agg[key] = {
-                        "date": dt_str,
-                        "department_name": dep_label,  # 用筛选的科室名回填
-                        "doctor_id": doc_code,
-                        "doctor_name": doc_name,
-                        "item_class_name": item_class,
-                        "cost": costs,
-                        "revenue": costs,  # 保留兼容字段
-                        "quantity": amount,
-                    }
-                else:
-                    agg[key]["cost"] += costs
-                    agg[key]["revenue"] += costs
-                    agg[key]["quantity"] += amount
-
-            detail_rows = sorted(
-                agg.values(),
-                key=lambda x: (
-                    x.get("date") or "",
-                    x.get("doctor_id") or "",
-                    x.get("item_class_name") or "",
-                ),
-            )
-        else:
-            # 科室模式：
-            # - 无科室：日期、科室、收入
-            # - 有科室：日期、科室名、项目类名、收入、数量
-            has_deps = bool(deps)
-            agg: Dict[tuple, Dict[str, Any]] = {}
-
-            for r in base_rows_cur:
-                dt = _parse_date_str(r.get("rcpt_date"))
-                if not dt:
-                    continue
-                dt_str = dt.isoformat()
-                dep_code = r.get("dep_code")
-                dep_name = r.get("dep_name")
-                item_class = r.get("item_class_name")
-                charges = float(r.get("charges") or 0.0)
-                amount = float(r.get("amount") or 0.0)
-
-                if not has_deps:
-                    key = (dt_str, dep_name)
-                else:
-                    key = (dt_str, dep_name, item_class)
-
-                if key not in agg:
-                    row: Dict[str, Any] = {
-                        "date": dt_str,
-                        "department_code": dep_code,
-                        "department_name": dep_name,
-                        "revenue": charges,
-                    }
-                    if has_deps:
-                        row["item_class_name"] = item_class
-                        row["quantity"] = amount
-                    agg[key] = row
-                else:
-                    agg[key]["revenue"] += charges
-                    if has_deps:
-                        agg[key]["quantity"] = (agg[key].get("quantity") or 0.0) + amount
-
-            detail_rows = sorted(
-                agg.values(),
-                key=lambda x: (
-                    x.get("date") or "",
-                    x.get("department_name") or "",
-                    x.get("item_class_name") or "",
-                ),
-            )
-
-        return {
+        result = {
             "date_range": {"start": start.isoformat(), "end": end.isoformat()},
             "departments": deps,
             "doctors": docs,
             "summary": summary,
             "timeseries": ts_rows,
             "details": detail_rows,
-            "total": len(detail_rows),
+            "total": total,
         }
+        if cache_key is not None and len(detail_rows) <= HIST_RESULT_MAX_DETAIL_ROWS:
+            cache_set(cache_key, copy.deepcopy(result), ttl_seconds=HIST_RESULT_TTL_SECONDS)
+        return result
@@ -9,6 +9,7 @@ from flask import Blueprint, jsonify, request
 from .inpatient_total_revenue_service import (
     get_dep_doc_map,
     get_full_revenue,
+    init_cache_key,
 )
 from .....shared.validators import parse_date_generic
 from .....shared.cache import cache_get, cache_set
@@ -16,6 +17,13 @@ from .....shared.cache import cache_get, cache_set
 logger = logging.getLogger("inpatient_total_revenue.routes")
 bp = Blueprint("inpatient_total_revenue", __name__)
 
+# /init 结果按日期分 key（响应里带当天日期），同一天内 10 分钟刷新一次
+INIT_CACHE_TTL_SECONDS = 600
+
+# /query 明细分页上限：超出直接 400（否则超大值会在库里 bigint 越界变成 500）
+MAX_PAGE_LIMIT = 1000
+MAX_PAGE_OFFSET = 1_000_000
+
 
 def _parse_departments(payload: Dict[str, Any]) -> Optional[List[str]]:
     """
@@ -57,6 +65,20 @@ def _parse_doctors(payload: Dict[str, Any]) -> Optional[List[str]]:
     return out or None
 
 
+def _parse_int_arg(payload: Dict[str, Any], key: str) -> Optional[int]:
+    """
+    按键是否存在取整数参数（JSON body 优先，其次 query string），
+    不按真假判断，0 也算传了；未传 / 空串返回 None。
+    非整数（含 true/false、小数）抛 ValueError
+    """
+    raw = payload[key] if key in payload else request.args.get(key)
+    if raw is None or raw == "":
+        return None
+    if isinstance(raw, bool) or isinstance(raw, float):
+        raise ValueError(f"{key} 必须为整数")
+    return int(raw)
+
+
 @bp.route("/init", methods=["GET"])
 def init():
     """
@@ -65,13 +87,12 @@ def init():
       - 返回医生列表（带所在绩效科室）
     """
     try:
-        cache_key = "inpatient_total_revenue:init:v3"
+        today = date.today()
+        cache_key = init_cache_key(today)
         cached = cache_get(cache_key)
         if cached:
             return jsonify(cached), 200
 
-        today = date.today()
-
         rows = get_dep_doc_map()
 
         departments: List[Dict[str, Any]] = []
@@ -105,7 +126,7 @@ def init():
             "departments": departments,
             "doctors": doctors,
         }
-        cache_set(cache_key, body)
+        cache_set(cache_key, body, ttl_seconds=INIT_CACHE_TTL_SECONDS)
         return jsonify(body), 200
     except Exception as e:
         logger.exception("Error while processing /init: %s", e)
@@ -126,7 +147,9 @@ def query():
         "start_date": "2025-11-10",
         "end_date": "2025-11-14",       # 可选，省略视为单日
         "departments": ["儿科一病区"],  # 可选，绩效科室名称
-        "doctors": ["8035", "8036"]     # 可选，医生工号；有医生时后端会忽略科室收入查询中的部门条件
+        "doctors": ["8035", "8036"],    # 可选，医生工号；有医生时后端会忽略科室收入查询中的部门条件
+        "limit": 50,                    # 可选，明细分页大小（1~1000）；不传返回全部明细
+        "offset": 0                     # 可选，明细分页偏移；须与 limit 同时传
       }
     """
     try:
@@ -170,15 +193,49 @@ def query():
         departments = _parse_departments(payload)
         doctors = _parse_doctors(payload)
 
+        try:
+            limit = _parse_int_arg(payload, "limit")
+            offset = _parse_int_arg(payload, "offset")
+        except (TypeError, ValueError):
+            return (
+                jsonify({"success": False, "error": "limit / offset 必须为整数"}),
+                400,
+            )
+        if offset is not None and limit is None:
+            return (
+                jsonify({"success": False, "error": "传 offset 时必须同时传 limit"}),
+                400,
+            )
+        if (limit is not None and limit <= 0) or (offset is not None and offset < 0):
+            return (
+                jsonify({"success": False, "error": "limit 必须大于 0，offset 不能小于 0"}),
+                400,
+            )
+        if (limit is not None and limit > MAX_PAGE_LIMIT) or (
+            offset is not None and offset > MAX_PAGE_OFFSET
+        ):
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "error": f"limit 不能超过 {MAX_PAGE_LIMIT}，offset 不能超过 {MAX_PAGE_OFFSET}",
+                    }
+                ),
+                400,
+            )
+        offset = offset or 0
+
         logger.info(
-            "/query | sd=%s ed=%s departments=%s doctors=%s",
+            "/query | sd=%s ed=%s departments=%s doctors=%s limit=%s offset=%s",
             sd,
             ed_exclusive,
             departments,
             doctors,
+            limit,
+            offset,
         )
 
-        data = get_full_revenue(sd, ed_exclusive, departments, doctors)
+        data = get_full_revenue(sd, ed_exclusive, departments, doctors, limit, offset)
         body = {"success": True, **data}
         return jsonify(body), 200
     except Exception as e:
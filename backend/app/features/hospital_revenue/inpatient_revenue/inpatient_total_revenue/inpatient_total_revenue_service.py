@@ -4,7 +4,10 @@ import logging
 from datetime import date
 from typing import Any, Dict, List, Optional
 
-from .inpatient_total_revenue_repository import InpatientTotalRevenueRepository
+from .inpatient_total_revenue_repository import (
+    InpatientTotalRevenueRepository,
+    init_cache_key,
+)
 
 logger = logging.getLogger("inpatient_total_revenue.service")
 
@@ -18,23 +21,35 @@ def get_dep_doc_map() -> List[Dict[str, Any]]:
     return _repo.get_dep_doc_map()
 
 
+def invalidate_dep_doc_map() -> None:
+    """
+    科室 / 医生映射维护后调用，清掉映射缓存和 /init 响应缓存。
+    """
+    _repo.invalidate_dep_doc_map()
+
+
 def get_full_revenue(
         start: date,
         end: date,
         departments: Optional[List[str]] = None,
         doctors: Optional[List[str]] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
 ) -> Dict[str, Any]:
     """
     统一查询入口：
     - start / end：日期（end 为「开区间」，一般为 查询结束日期 + 1 天）
     - departments：绩效科室名称列表（可空）
     - doctors：医生工号列表（可空）
+    - limit / offset：明细分页（可空，不传则返回全部明细）
     """
     logger.info(
-        "get_full_revenue | start=%s end=%s departments=%s doctors=%s",
+        "get_full_revenue | start=%s end=%s departments=%s doctors=%s limit=%s offset=%s",
         start,
         end,
         departments,
         doctors,
+        limit,
+        offset,
     )
-    return _repo.get_full_revenue(start, end, departments, doctors)
+    return _repo.get_full_revenue(start, end, departments, doctors, limit, offset)
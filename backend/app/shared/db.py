@@ -8,7 +8,7 @@ from dataclasses import dataclass, asdict
 
 from dotenv import load_dotenv
 from psycopg2 import pool, OperationalError, InterfaceError
-from psycopg2.extensions import connection, cursor
+from psycopg2.extensions import DECIMAL, connection, cursor, new_type, register_type
 from psycopg2.extras import RealDictCursor
 
 
@@ -385,6 +385,30 @@ def get_dict_cursor(silent: bool = False) -> RealDictCursor:
         yield cur
 
 
+# NUMERIC -> float 类型转换：由驱动在解析结果时直接产出 float，不再构造 Decimal
+DEC2FLOAT = new_type(
+    DECIMAL.values,
+    "DEC2FLOAT",
+    lambda v, _cur: float(v) if v is not None else None,
+)
+
+
+def use_float_numeric(cur: cursor) -> cursor:
+    """让该游标把 NUMERIC 直接返回为 float。
+
+    只作用于传入的游标（不做全局注册），依赖 Decimal 的旧模块不受影响。
+    """
+    register_type(DEC2FLOAT, cur)
+    return cur
+
+
+def get_pool_max_connections() -> int:
+    """连接池连接数上限（连接池未初始化时按环境变量配置）"""
+    if _pg_pool is not None:
+        return _pg_pool.maxconn
+    return _get_pool_config().max_connections
+
+
 def get_pool_stats() -> Dict[str, Any]:
     """获取连接池统计信息"""
     stats = asdict(_pool_stats)